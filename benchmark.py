@@ -0,0 +1,334 @@
+from itertools import combinations, product
+from multiprocessing import Pool
+from random import Random
+import codecs
+import json
+import os
+import resource
+import sys
+import time
+import unicodedata
+import find_dupes
+
+##
+# Config
+##
+
+# the number of records in the synthetic corpus and the share from EndNote
+n_records = 10000
+endnote_share = 0.75
+
+# the share of works that appear more than once, and the most copies of a work
+dupe_rate = 0.2
+max_copies = 3
+
+# the share of distinct works that are related to an earlier work, i.e. share
+# its first author and year, and often its journal or leading title words
+related_rate = 0.2
+
+# the chance that each perturbation is applied to a duplicate
+p_truncate_title = 0.3
+p_truncate_authors = 0.5
+p_diacritics = 0.2
+p_year_off_by_one = 0.1
+
+# the parameter settings to benchmark; every combination is run
+thresholds = [0.5, 0.6, 0.7]
+perms = [128, 256]
+shingle_sizes = [3]
+author_year_indexes = [False, True]
+ceilings = [0.85, 0.9]
+
+# seed of the random generator, so runs can be compared
+seed = 1
+
+# if set, also write the corpus as endnote.txt and results/ json files to this directory
+corpus_dir = None
+
+
+##
+# Generate a corpus
+##
+
+syllables = ['ba', 'co', 'de', 'fi', 'ga', 'he', 'ki', 'lo', 'ma', 'ne', 'po',
+  'ra', 'si', 'ta', 'vo', 'wi', 'ze', 'an', 'er', 'in', 'ol', 'us', 'tr', 'st']
+
+accents = {'a': 'á', 'e': 'é', 'i': 'í', 'o': 'ö', 'u': 'ü', 'c': 'ç', 'n': 'ñ'}
+
+
+def get_word(rand, n_syllables = None):
+  '''Return a random pseudo-word'''
+  return ''.join(rand.choice(syllables) for _ in range(n_syllables or rand.randint(1, 4)))
+
+
+def get_work(rand, work_id):
+  '''
+  Return a dictionary that represents one work, i.e. the reference that
+  all duplicate records of the work are derived from
+  '''
+  n_authors = rand.choice([1, 1, 2, 2, 3, 4, 6])
+  journal = ' '.join(get_word(rand).capitalize() for _ in range(rand.randint(2, 5)))
+  first_page = rand.randint(1, 900)
+  return {
+    'work': work_id,
+    'authors': [(get_word(rand, rand.randint(2, 3)).capitalize(),
+      ''.join(rand.choice('ABCDEFGHJKLMNPRSTW') for _ in range(rand.randint(1, 2))))
+      for _ in range(n_authors)],
+    'year': rand.randint(1950, 2018),
+    'title': ' '.join(get_word(rand) for _ in range(rand.randint(4, 14))).capitalize(),
+    'journal': journal,
+    'volume': str(rand.randint(1, 120)),
+    'pages': str(first_page) + '-' + str(first_page + rand.randint(5, 40)),
+  }
+
+
+def get_related_work(rand, base, work_id):
+  '''
+  Return a work that is distinct from `base` but shares its first author and
+  year, and often its journal or leading title words, as the papers of a
+  series or the chapters of a book do
+  '''
+  work = get_work(rand, work_id)
+  work['authors'] = base['authors'][:1] + work['authors'][1:]
+  work['year'] = base['year'] + rand.choice([-1, 0, 0, 0])
+  if rand.random() < 0.5:
+    for key in ['journal', 'volume']:
+      work[key] = base[key]
+  words = base['title'].split(' ')
+  roll = rand.random()
+  if roll < 0.3:
+    # e.g. part 1 and part 2 of a paper, which differ in their last word
+    work['authors'] = base['authors']
+    work['title'] = ' '.join(words[:-1] + [get_word(rand)])
+  elif roll < 0.7:
+    n_shared = rand.randint(3, max(3, len(words) - 1))
+    work['title'] = ' '.join(words[:n_shared] + work['title'].split(' ')[n_shared:])
+  return work
+
+
+def get_endnote_style(work, title, authors, year):
+  '''Return the record of `work` as it appears in the EndNote export'''
+  names = [surname + ', ' + '. '.join(initials) + '.' for surname, initials in authors]
+  if len(names) > 1:
+    names = [', '.join(names[:-1]), names[-1]]
+  return {
+    'authors': ' & '.join(names),
+    'year': str(year),
+    'title': title,
+    'source': ' '.join([work['journal'], work['volume'], work['pages']]),
+    'url': '',
+    'collection': 'endnote',
+  }
+
+
+def get_scholar_style(rand, work, title, authors, year):
+  '''Return the record of `work` as it appears in Google Scholar results'''
+  names = [initials + ' ' + surname for surname, initials in authors]
+  if len(names) > 3:
+    names = names[:3]
+    names[-1] += '…'
+  source = work['journal']
+  if rand.random() < 0.5:
+    source = source[:rand.randint(10, 25)]
+  return {
+    'authors': ', '.join(names),
+    'year': str(year),
+    'title': title,
+    'source': source,
+    'url': '',
+    'collection': 'google',
+  }
+
+
+def add_diacritics(rand, string):
+  '''Accent or strip the accents from some characters of `string`'''
+  if any(ord(i) > 127 for i in string):
+    return ''.join(i for i in unicodedata.normalize('NFKD', string) if not unicodedata.combining(i))
+  return ''.join(accents[i] if i in accents and rand.random() < 0.3 else i for i in string)
+
+
+def get_copy(rand, work, collection, perturb):
+  '''
+  Return one record of `work` in the style of `collection`. If perturb is
+  True, apply the perturbations seen between real duplicates.
+  '''
+  title = work['title']
+  authors = work['authors']
+  year = work['year']
+  if perturb:
+    if rand.random() < p_truncate_title:
+      words = title.split(' ')
+      title = ' '.join(words[:max(2, len(words) - rand.randint(1, 4))]) + '…'
+    if rand.random() < p_truncate_authors and len(authors) > 1:
+      authors = authors[:rand.randint(1, len(authors) - 1)]
+    if rand.random() < p_diacritics:
+      title = add_diacritics(rand, title)
+      authors = [(add_diacritics(rand, surname), initials) for surname, initials in authors]
+    if rand.random() < p_year_off_by_one:
+      year += rand.choice([-1, 1])
+
+  if collection == 'endnote':
+    record = get_endnote_style(work, title, authors, year)
+  else:
+    record = get_scholar_style(rand, work, title, authors, year)
+  record['work'] = work['work']
+  return record
+
+
+def get_corpus(n, rand):
+  '''
+  Return a list of `n` synthetic records. Records derived from the same
+  work share the value of their 'work' key.
+  '''
+  corpus = []
+  works = []
+  while len(corpus) < n:
+    if works and rand.random() < related_rate:
+      work = get_related_work(rand, rand.choice(works), len(works))
+    else:
+      work = get_work(rand, len(works))
+    works.append(work)
+    n_copies = rand.randint(2, max_copies) if rand.random() < dupe_rate else 1
+    for copy_idx in range(min(n_copies, n - len(corpus))):
+      collection = 'endnote' if rand.random() < endnote_share else 'google'
+      record = get_copy(rand, work, collection, perturb = copy_idx > 0)
+      record['id'] = collection + '-' + str(len(corpus))
+      corpus.append(record)
+  rand.shuffle(corpus)
+  return corpus
+
+
+def write_corpus(corpus, out_dir):
+  '''
+  Write the EndNote records of `corpus` to `out_dir`/endnote.txt and the
+  Google records to `out_dir`/results/synthetic, as find_dupes.py reads them
+  '''
+  results_dir = os.path.join(out_dir, 'results', 'synthetic')
+  if not os.path.exists(results_dir):
+    os.makedirs(results_dir)
+  with codecs.open(os.path.join(out_dir, 'endnote.txt'), 'w', 'utf8') as out:
+    for i in corpus:
+      if i['collection'] == 'endnote':
+        out.write('\t'.join([i['authors'], i['year'], i['title'], i['source']]) + '\n')
+  for i in corpus:
+    if i['collection'] == 'google':
+      with open(os.path.join(results_dir, i['id'] + '.json'), 'w') as out:
+        json.dump({key: i[key] for key in ['url', 'authors', 'title', 'year', 'source']}, out)
+
+
+##
+# Benchmark
+##
+
+def get_true_pairs(corpus):
+  '''Return the set of index pairs of records in `corpus` that share a work'''
+  by_work = {}
+  for idx, i in enumerate(corpus):
+    by_work.setdefault(i['work'], []).append(idx)
+  return set(pair for idxs in by_work.values() for pair in combinations(idxs, 2))
+
+
+def get_scores(found, truth):
+  '''Return the precision and recall of the pairs in `found`'''
+  hits = len(found & truth)
+  return {
+    'pairs': len(found),
+    'precision': hits / len(found) if found else 1.0,
+    'recall': hits / len(truth) if truth else 1.0,
+  }
+
+
+def run_setting(args):
+  '''
+  Run the non-interactive dedupe stages of find_dupes.py on `corpus` with
+  one parameter setting and return the throughput, peak memory and the
+  precision and recall of the candidate and auto-resolved pairs
+  '''
+  corpus, setting = args
+  find_dupes.threshold = setting['threshold']
+  find_dupes.n_perms = setting['n_perms']
+  find_dupes.shingle_size = setting['shingle_size']
+  find_dupes.author_year_index = setting['author_year_index']
+  find_dupes.title_key_words = 3
+  find_dupes.n_shards = 1
+  find_dupes.developing = False
+  find_dupes.progress_interval = float('inf')
+  find_dupes.db = find_dupes.open_project_store(':memory:')
+
+  start = time.perf_counter()
+  rows = [find_dupes.add_record(i) for i in corpus]
+  clusters = find_dupes.find_clusters(rows)
+  lsh_seconds = time.perf_counter() - start
+
+  # map the rows in the record table back to positions in `corpus`
+  positions = {row: idx for idx, row in enumerate(rows)}
+  candidates = set()
+  for cluster in clusters:
+    for a, b in combinations(sorted(positions[row] for row in cluster), 2):
+      candidates.add((a, b))
+
+  # score each distinct multi-record cluster as the review queue does
+  start = time.perf_counter()
+  reviews = []
+  for cluster in set(tuple(i) for i in clusters if len(i) > 1):
+    reviews.append(find_dupes.score_cluster([find_dupes.get_record(row) for row in cluster]))
+  similarity_seconds = time.perf_counter() - start
+
+  truth = get_true_pairs(corpus)
+  peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform != 'darwin':
+    peak_memory *= 1024
+
+  results = []
+  for ceiling in ceilings:
+    # the pairs identify_diplomats resolves without prompting the user
+    find_dupes.ceiling = ceiling
+    auto = set(tuple(sorted(positions[i['row']] for i in review['cluster']))
+      for review in reviews if find_dupes.is_clear_dupe(review))
+    result = dict(setting, ceiling = ceiling)
+    result['records_per_second'] = len(corpus) / lsh_seconds
+    result['similarity_seconds'] = similarity_seconds
+    result['peak_memory_mb'] = peak_memory / 2**20
+    result['candidates'] = get_scores(candidates, truth)
+    result['auto_resolved'] = get_scores(auto, truth)
+    results.append(result)
+  return results
+
+
+def print_results(results):
+  '''Print one line per parameter setting'''
+  cols = ['threshold', 'n_perms', 'shingle', 'auth-yr', 'ceiling', 'rec/s', 'peak MB',
+    'cand', 'cand P', 'cand R', 'auto P', 'auto R']
+  print('\t'.join(cols))
+  for i in results:
+    print('\t'.join(str(val) for val in [
+      i['threshold'], i['n_perms'], i['shingle_size'], i['author_year_index'], i['ceiling'],
+      int(i['records_per_second']), int(i['peak_memory_mb']),
+      i['candidates']['pairs'],
+      round(i['candidates']['precision'], 3), round(i['candidates']['recall'], 3),
+      round(i['auto_resolved']['precision'], 3), round(i['auto_resolved']['recall'], 3),
+    ]))
+
+
+if __name__ == '__main__':
+
+  print(' * generating', n_records, 'records')
+  corpus = get_corpus(n_records, Random(seed))
+  print(' *', len(get_true_pairs(corpus)), 'duplicate pairs in corpus')
+
+  if corpus_dir:
+    write_corpus(corpus, corpus_dir)
+
+  settings = [{'threshold': t, 'n_perms': n, 'shingle_size': s, 'author_year_index': a}
+    for t, n, s, a in product(thresholds, perms, shingle_sizes, author_year_indexes)]
+
+  # run each setting in a fresh process so its peak memory can be measured
+  results = []
+  for setting in settings:
+    print(' * running', setting)
+    with Pool(1) as pool:
+      results += pool.map(run_setting, [(corpus, setting)])[0]
+
+  print_results(results)
+  with open('benchmark.json', 'w') as out:
+    json.dump(results, out, indent = 2)
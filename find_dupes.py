@@ -3,73 +3,356 @@ from datasketch import MinHash, MinHashLSH
 from nltk import ngrams
 from difflib import SequenceMatcher
 from random import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import cProfile
 import codecs
 import datetime
 import json
+import numpy as np
 import os
+import pickle
+import queue
+import re
+import sqlite3
 import sys
+import threading
+import time
+import tracemalloc
+import unicodedata
+import xml.etree.ElementTree as ElementTree
 
 ##
-# Get Data
+# Record table
 ##
 
-def get_google_vals():
+# the fields stored for each record, in the order they are written to tsv files
+record_fields = ['id', 'authors', 'year', 'title', 'source', 'url', 'collection']
+
+# each field is a column whose nth value belongs to the record in row n
+records = {field: [] for field in record_fields}
+
+# map each record id to its row in `records`
+record_rows = {}
+
+
+def add_record(obj):
+  '''
+  Add the record `obj` to the record table and return its row. If a record
+  with the same id is already present, its values are replaced by `obj`.
   '''
-  Get a list of dictionaries, where each dictionary represents
-  a distinct citation in Google Scholar.
+  row = record_rows.get(obj['id'])
+  if row is None:
+    row = len(records['id'])
+    record_rows[obj['id']] = row
+    for field in record_fields:
+      records[field].append(None)
+  for field in record_fields:
+    records[field][row] = sys.intern(str(obj.get(field, '') or ''))
+  return row
+
+
+def get_record(row):
   '''
+  Return a dictionary with the values of the record in `row` of the
+  record table. The row itself is stored in the 'row' key.
+  '''
+  obj = {field: records[field][row] for field in record_fields}
+  obj['row'] = row
+  return obj
 
-  # get google result list
-  google_vals = []
-  for i in glob('results/*/*.json'):
-    with open(i) as f:
-      google_dict = json.load(f)
-      google_id = os.path.basename(i).replace('.json', '')
-      google_dict['google_id'] = google_id
-      google_dict['id'] = google_id
-      google_dict['collection'] = 'google'
-      google_vals.append(google_dict)
 
-  # dedupe using only unique google ids
-  google_vals_by_id = {}
-  for i in google_vals:
-    google_vals_by_id[i['google_id']] = i
+##
+# Get Data
+##
 
-  goog_records = google_vals_by_id.values()
+def get_google_vals():
+  '''
+  Add each distinct citation in Google Scholar to the record table
+  and return the list of their rows.
+  '''
+
+  # get google result list, keyed by google id to dedupe ids found in several runs
+  google_vals = {}
+  for result_dir, results in sorted(load_google_results().items()):
+    for google_dict in results:
+      google_vals[google_dict['id']] = add_record(google_dict)
 
   # if deduping only new google records, retain only new google ids
   if only_process_new_google:
-    used_goog_ids = set(open('lists/processed_google_ids.txt').read().split('\n'))
-    return [i for i in goog_records if i['google_id'] not in used_goog_ids]
-  return goog_records
+    return [row for google_id, row in google_vals.items() if not is_processed(google_id)]
+  return list(google_vals.values())
+
+
+# the records in results/ by directory and json file name, with the
+# modification time of each directory when its files were listed
+google_results = None
+
+
+def load_google_results():
+  '''
+  Return a dictionary that maps each directory in results/ to the list of
+  records scraped into it
+  '''
+  update_google_results()
+  return {result_dir: list(cached['files'].values()) for result_dir, cached in google_results.items()}
+
+
+def update_google_results(save = True):
+  '''
+  Read the json files in results/ that are not in `google_results` yet, in
+  parallel, and return the list of their records. The state is loaded from
+  the snapshot at `google_cache_path` on the first call, and only the
+  directories modified since their files were last listed are listed
+  again. If save is True, the snapshot is updated when the state changes.
+  '''
+  global google_results
+  if google_results is None:
+    google_results = {}
+    if os.path.exists(google_cache_path):
+      google_results = load_pickle(google_cache_path)
+
+  result_dirs = glob(os.path.join('results', '*', ''))
+  changed = set(result_dirs) != set(google_results)
+  for result_dir in set(google_results) - set(result_dirs):
+    del google_results[result_dir]
+
+  new_paths = []
+  for result_dir in result_dirs:
+    # get the modification time before listing the files, so files the
+    # scraper adds while they are read invalidate the listing
+    mtime = os.stat(result_dir).st_mtime_ns
+    cached = google_results.setdefault(result_dir, {'mtime': None, 'files': {}})
+    if cached['mtime'] == mtime:
+      continue
+    changed = True
+    paths = glob(os.path.join(result_dir, '*.json'))
+    names = set(os.path.basename(path) for path in paths)
+    cached['mtime'] = mtime
+    cached['files'] = {name: val for name, val in cached['files'].items() if name in names}
+    new_paths += [path for path in paths if os.path.basename(path) not in cached['files']]
+
+  new_records = []
+  if new_paths:
+    print(' * reading', len(new_paths), 'Google results from disk')
+    with ThreadPoolExecutor(max_workers = 16) as executor:
+      for path, google_dict in zip(new_paths, executor.map(read_google_result, new_paths)):
+        cached = google_results[os.path.join(os.path.dirname(path), '')]
+        # a file the scraper is still writing is read again on the next call
+        if google_dict is None:
+          cached['mtime'] = None
+        else:
+          cached['files'][os.path.basename(path)] = google_dict
+          new_records.append(google_dict)
+
+  if save and changed:
+    save_google_results()
+  return new_records
+
+
+def save_google_results():
+  '''Save `google_results` to `google_cache_path`'''
+  save_pickle(google_cache_path, google_results)
+
+
+def read_google_result(path):
+  '''
+  Return the record saved in the json file at `path` by the Google Scholar
+  scraper, or None if the file is not valid json
+  '''
+  with open(path) as f:
+    try:
+      google_dict = json.load(f)
+    except ValueError:
+      return None
+  google_dict['id'] = os.path.basename(path).replace('.json', '')
+  google_dict['collection'] = 'google'
+  return google_dict
 
 
 def get_endnote_vals():
   '''
-  Get a list of dictionaries, where each dictionary represents
-  a distinct citation in EndNote.
+  Add each distinct citation in EndNote to the record table
+  and return the list of their rows.
   '''
   endnote_vals = []
 
-  # get endnote result list
-  with open('endnote.txt') as f:
-    endnote = f.read().split('\n')
-
-  for i in endnote:
-    cells = i.split('\t')
-    author, year, title, source = cells
-    endnote_vals.append({
-      'authors': author,
-      'year': year,
-      'title': title,
-      'source': source,
+  # stream the endnote result list
+  for i in iter_endnote_records(endnote_path):
+    endnote_vals.append(add_record({
+      'authors': i['authors'],
+      'year': i['year'],
+      'title': i['title'],
+      'source': i['source'],
       'id': 'endnote-' + str(random() * 2**64),
       'url': '',
       'collection': 'endnote',
-    })
+    }))
   return endnote_vals
 
 
+def iter_endnote_records(path):
+  '''
+  Yield one dictionary with 'authors', 'year', 'title' and 'source' keys
+  for each reference in the EndNote export at `path`. RIS (.ris) and
+  EndNote XML (.xml) exports are parsed directly, any other file is read
+  as the tab-separated author, year, title, source layout.
+  '''
+  ext = os.path.splitext(path)[1].lower()
+  if ext == '.ris':
+    yield from iter_ris_records(path)
+  elif ext == '.xml':
+    yield from iter_endnote_xml_records(path)
+  else:
+    yield from iter_tsv_records(path)
+  malformed_summary(path)
+
+
+def iter_tsv_records(path):
+  '''
+  Yield the references in the tab-separated EndNote export at `path`,
+  one line at a time. Blank lines are skipped and malformed lines reported.
+  '''
+  # split on newlines only, as titles may contain form feeds and other breaks
+  with open(path, encoding = 'utf8', newline = '\n') as f:
+    for line_number, line in enumerate(f, 1):
+      line = line.rstrip('\r\n')
+      if not line.strip():
+        continue
+      cells = line.split('\t')
+      # drop the empty cells of trailing tabs
+      while len(cells) > 4 and not cells[-1]:
+        cells.pop()
+      if len(cells) < 4:
+        malformed_msg(path, line_number, line)
+        continue
+      # the cells between year and source are taken to be a title that
+      # contains tabs, which cannot be told apart from a stray cell
+      if len(cells) > 4:
+        malformed_msg(path, line_number, line, 'tabs')
+      yield {
+        'authors': cells[0],
+        'year': cells[1],
+        'title': '\t'.join(cells[2:-1]),
+        'source': cells[-1],
+      }
+
+
+def iter_ris_records(path):
+  '''
+  Yield the references in the RIS export at `path`, one record at a time
+  '''
+  fields = {}
+  with open(path, encoding = 'utf-8-sig', newline = '\n') as f:
+    for line_number, line in enumerate(f, 1):
+      line = line.rstrip('\r\n')
+      if not line.strip():
+        continue
+      # each line looks like `TY  - JOUR`
+      if len(line) < 5 or line[2:5] != '  -':
+        malformed_msg(path, line_number, line)
+        continue
+      tag = line[:2]
+      value = line[6:].strip()
+      if tag == 'ER':
+        yield get_endnote_record(
+          fields.get('AU', []) + fields.get('A1', []),
+          (fields.get('PY', []) + fields.get('Y1', []) + [''])[0][:4],
+          (fields.get('TI', []) + fields.get('T1', []) + [''])[0],
+          (fields.get('T2', []) + fields.get('JO', []) + fields.get('JF', []) + [''])[0],
+          (fields.get('VL', []) + [''])[0],
+          '-'.join(fields.get('SP', []) + fields.get('EP', [])),
+        )
+        fields = {}
+      else:
+        fields.setdefault(tag, []).append(value)
+  if fields:
+    malformed_msg(path, line_number, 'record without an ER tag')
+
+
+def iter_endnote_xml_records(path):
+  '''
+  Yield the references in the EndNote XML export at `path`. Each record
+  is detached from the tree once parsed, so memory use does not grow with
+  the file.
+  '''
+  def text(record, tag):
+    elem = record.find(tag)
+    return ''.join(elem.itertext()).strip() if elem is not None else ''
+
+  # the elements that enclose the element being parsed
+  parents = []
+  try:
+    for event, record in ElementTree.iterparse(path, events = ('start', 'end')):
+      if event == 'start':
+        parents.append(record)
+        continue
+      parents.pop()
+      if record.tag != 'record':
+        continue
+      yield get_endnote_record(
+        [''.join(i.itertext()).strip() for i in record.iterfind('contributors/authors/author')],
+        text(record, 'dates/year')[:4],
+        text(record, 'titles/title'),
+        text(record, 'titles/secondary-title'),
+        text(record, 'volume'),
+        text(record, 'pages'),
+      )
+      if parents:
+        parents[-1].remove(record)
+  except ElementTree.ParseError as exc:
+    malformed_msg(path, exc.position[0], str(exc))
+
+
+def get_endnote_record(authors, year, title, journal, volume, pages):
+  '''
+  Return a dictionary that holds the reference in the layout of the
+  tab-separated EndNote export, e.g. 'Smith, A., Doe, J. & Jones, B.' and
+  'Journal of Things 4 166-179'
+  '''
+  if len(authors) > 1:
+    authors = [', '.join(authors[:-1]), authors[-1]]
+  return {
+    'authors': ' & '.join(authors),
+    'year': year,
+    'title': title,
+    'source': ' '.join([i for i in [journal, volume, pages] if i]),
+  }
+
+
+# the warnings about records in EndNote exports: the message for one record
+# and the message for the number of records in the export
+malformed_problems = {
+  'skipped': ('Skipping malformed record', 'malformed records skipped'),
+  'tabs': ('Reading title with tabs in record', 'titles with tabs read'),
+}
+
+# the number of records of each problem in each EndNote export
+malformed_counts = {}
+
+
+def malformed_msg(path, line_number, line, problem = 'skipped'):
+  '''
+  Generate warning message when a record in an EndNote export cannot be parsed,
+  or is parsed as it contains a title with tabs. Only the first
+  `max_malformed_msgs` records of each problem in an export are printed.
+  '''
+  counts = malformed_counts.setdefault(path, {})
+  counts[problem] = counts.get(problem, 0) + 1
+  if counts[problem] <= max_malformed_msgs:
+    msg = malformed_problems[problem][0]
+    print(' ! Warning: ' + msg + ' in ' + path + ' at line ' + str(line_number) + ': ' + line[:80])
+
+
+def malformed_summary(path):
+  '''
+  Generate warning message with the number of records of each problem in
+  the EndNote export at `path`
+  '''
+  for problem, count in sorted(malformed_counts.pop(path, {}).items()):
+    print(' ! Warning: ' + str(count) + ' ' + malformed_problems[problem][1] + ' in ' + path)
+
+
 def get_metadata_string(obj):
   '''
   Given an object with 'title' and 'authors' keys, return a string
@@ -78,11 +361,11 @@ def get_metadata_string(obj):
   return obj['title'] + '-' + obj['authors']
 
 
-def override_msg(filename, collection):
+def override_msg(stage, collection):
   '''
   Generate warning message when user config is overridden to get data
   '''
-  msg = '\n\n ! Warning: ' + filename + ' not found on disk. Processing all '
+  msg = '\n\n ! Warning: No ' + stage + ' decisions found in ' + db_path + '. Processing all '
   msg += collection + ' records.\n'
   print(msg)
 
@@ -93,11 +376,10 @@ def override_msg(filename, collection):
 
 def prepare_directories():
   '''
-  Prepare the directories for .json and .tsv files.
+  Prepare the directory for .tsv files.
   '''
-  for i in ['lists', 'json']:
-    if not os.path.exists(i):
-      os.makedirs(i)
+  if not os.path.exists('lists'):
+    os.makedirs('lists')
 
 
 ##
@@ -106,55 +388,373 @@ def prepare_directories():
 
 def find_clusters(arr):
   '''
-  `arr` is a list of dictionaries where each dictionary represents
-  the content from one Google or EndNote record. Return a list of lists,
-  where each sublist contains objects that have been identified as being
-  similar to one another by minhashing.
+  `arr` is a list of rows in the record table, where each row represents
+  one Google or EndNote record. Return a list of lists, where each sublist
+  contains the rows that have been identified as being similar to one
+  another by minhashing.
   '''
 
   arr = list(arr)
   if developing:
     arr = arr[:max_dev_records]
 
-  minhashes = [] # a list of the generated minhashes
   clusters = [] # a list of lists where each sublist is a group of clustered records
-  index = MinHashLSH(threshold = threshold, num_perm = n_perms)
 
-  # add all strings to the lsh index
-  for idx, i in enumerate(arr):
-    print(' indexed', idx + 1, 'of', len(arr))
-    metadata_string = get_metadata_string(i)
-    m = MinHash(num_perm = n_perms)
-    for chars in ngrams(metadata_string, 3):
-      window = ''.join(chars)
-      m.update(window.encode('utf8'))
+  # records with the same first author, year and leading title words
+  # are candidates as well
+  if author_year_index:
+    with timed('query'):
+      author_year_matches = find_author_year_matches(arr)
+
+  # minhash the records and find the lsh bands they share in shard processes
+  if n_shards > 1:
+    for idx, matches in enumerate(find_sharded_matches(arr)):
+      if author_year_index:
+        matches = set(matches) | author_year_matches[idx]
+      clusters.append([arr[j] for j in sorted(matches)])
+    return clusters
+
+  # minhash all strings, reusing signatures from earlier runs
+  minhashes = [] # a list of the generated minhashes
+  new_signatures = []
+  for idx, row in enumerate(arr):
+    print_progress('minhashed', idx, len(arr))
+    with timed('signature'):
+      minhashes.append(get_minhash(row, new_signatures))
+
+  with timed('signature'), db:
+    db.executemany('INSERT OR IGNORE INTO signatures VALUES (?, ?, ?, ?)', new_signatures)
+
+  # add all minhashes to the lsh index
+  index = MinHashLSH(threshold = threshold, num_perm = n_perms)
+  for idx, m in enumerate(minhashes):
+    print_progress('indexed', idx, len(arr))
     # use the index position of this observation as the key for the obs
-    minhashes.append(m)
-    index.insert(idx, m)
+    with timed('index build'):
+      index.insert(idx, m)
 
   # for each string, find those sufficiently similar
   for idx in range(len(arr)):
-    print(' querying for', idx + 1)
+    print_progress('queried', idx, len(arr))
     # find the `nth` minhash in the minhashes
-    matches = index.query(minhashes[idx])
+    with timed('query'):
+      matches = index.query(minhashes[idx])
+    if author_year_index:
+      matches = set(matches) | author_year_matches[idx]
     # build a cluster of the records that match this query + the query itself
-    cluster = [arr[j] for j in matches]
+    cluster = [arr[j] for j in sorted(matches)]
     # get a list of `arr` values that are part of this cluster
     clusters.append(cluster)
   return clusters
 
 
+def get_author_year_key(obj):
+  '''
+  Return the key of `obj` in the author-year index, which is made of the
+  normalised surname of the first author, the year as an int and the first
+  `title_key_words` words of the title. Return None if the record has no
+  author or title.
+  '''
+  first_author = get_first_author(obj)
+  title = get_title_words(obj)
+  if not first_author or not title:
+    return None
+  year = re.search(r'\d{4}', obj['year'])
+  return (first_author, int(year.group()) if year else None, tuple(title[:title_key_words]))
+
+
+def get_first_author(obj):
+  '''Return the normalised surname of the first author of `obj`, or None'''
+  # the first author is `Smith, A.` in EndNote and `A Smith` in Google
+  first_author = normalize(re.split('[,&]', obj['authors'])[0]).split()
+  return first_author[-1] if first_author else None
+
+
+def get_title_words(obj):
+  '''Return the list of normalised words in the title of `obj`'''
+  # drop google's `[CITATION][C]`, `[BOOK][B]` and similar prefixes
+  return normalize(re.sub(r'^(\s*\[[^\]]*\])+', '', obj['title'])).split()
+
+
+def is_title_match(obj_a, obj_b):
+  '''
+  Return True if `obj_a` and `obj_b` share the surname of their first author
+  and the normalised title of one starts with that of the other, as when
+  Google Scholar truncates a title or drops its subtitle. The shorter title
+  must have at least `title_key_words` words.
+  '''
+  if not get_first_author(obj_a) or get_first_author(obj_a) != get_first_author(obj_b):
+    return False
+  shorter, longer = sorted([get_title_words(obj_a), get_title_words(obj_b)], key = len)
+  if len(shorter) < title_key_words:
+    return shorter == longer and len(shorter) > 0
+  # the last word of a truncated title may be cut off
+  return ' '.join(longer).startswith(' '.join(shorter))
+
+
+def get_author_year_query_keys(key):
+  '''
+  Return the keys to look up in the author-year index for a record with
+  `key`, allowing the year to be off by one
+  '''
+  surname, year, words = key
+  if year is None:
+    return [key]
+  return [(surname, year + offset, words) for offset in (-1, 0, 1)]
+
+
+def find_author_year_matches(arr):
+  '''
+  `arr` is a list of rows in the record table. Return a list with the set of
+  indices in `arr` of the records that share an author-year key with each
+  record, including the record itself.
+  '''
+  keys = [get_author_year_key(get_record(row)) for row in arr]
+  key_index = {}
+  for idx, key in enumerate(keys):
+    if key:
+      key_index.setdefault(key, []).append(idx)
+
+  matches = []
+  for idx, key in enumerate(keys):
+    found = set([idx])
+    if key:
+      for query_key in get_author_year_query_keys(key):
+        found.update(key_index.get(query_key, []))
+    matches.append(found)
+  return matches
+
+
+def normalize(string):
+  '''
+  Lowercase `string`, strip its diacritics and replace the characters that
+  are not letters or digits with spaces
+  '''
+  string = unicodedata.normalize('NFKD', string.lower())
+  return ''.join(i if i.isalnum() else ' ' for i in string if not unicodedata.combining(i))
+
+
+def get_minhash(row, new_signatures):
+  '''
+  Return the MinHash of the metadata string of the record in `row`. If it
+  is not saved in the project store yet, compute it and append it to
+  `new_signatures` so the caller can save it.
+  '''
+  metadata_string = get_metadata_string(get_record(row))
+  m = get_stored_signature(metadata_string)
+  if m is None:
+    m = compute_minhash(metadata_string, n_perms, shingle_size)
+    new_signatures.append((metadata_string, n_perms, shingle_size, m.hashvalues.tobytes()))
+  return m
+
+
+def compute_minhash(metadata_string, num_perm, n_chars):
+  '''
+  Return the MinHash with `num_perm` permutations of the `n_chars` character
+  shingles of `metadata_string`
+  '''
+  m = MinHash(num_perm = num_perm, permutations = get_permutations(num_perm))
+  for chars in ngrams(metadata_string, n_chars):
+    window = ''.join(chars)
+    m.update(window.encode('utf8'))
+  return m
+
+
+# the permutations of the MinHash functions for each number of permutations
+permutations = {}
+
+
+def get_permutations(num_perm):
+  '''
+  Return the permutations of a MinHash with `num_perm` permutations. They are
+  the same for every MinHash, so they are generated once and shared.
+  '''
+  if num_perm not in permutations:
+    permutations[num_perm] = MinHash(num_perm = num_perm).permutations
+  return permutations[num_perm]
+
+
+##
+# Sharded lsh
+##
+
+def find_sharded_matches(arr):
+  '''
+  `arr` is a list of rows in the record table. Return a list with the sorted
+  indices in `arr` of the records that share at least one lsh band with each
+  record, as MinHashLSH.query would. The work is split into `n_shards`
+  shards that exchange files in `shard_dir`. Each shard minhashes one range
+  of the records and splits their signatures by band, then buckets all
+  records by its share of the bands and saves the pairs of records that
+  collide. The pairs of all shards are merged.
+  '''
+  if not arr:
+    return []
+  if not os.path.exists(shard_dir):
+    os.makedirs(shard_dir)
+  for path in glob(os.path.join(shard_dir, '*')):
+    os.remove(path)
+
+  # deal the bands the lsh index would use round-robin to the shards
+  bands = MinHashLSH(threshold = threshold, num_perm = n_perms).hashranges
+  plan = {
+    'n_shards': n_shards,
+    'n_perms': n_perms,
+    'shingle_size': shingle_size,
+    'rows_per_band': bands[0][1] - bands[0][0],
+    'columns': [[col for start, end in bands[shard::n_shards] for col in range(start, end)]
+      for shard in range(n_shards)],
+  }
+
+  # save the metadata strings of each range of records and the signatures
+  # saved by earlier runs, then the plan, which tells workers to start
+  with timed('signature'):
+    for shard, idxs in enumerate(np.array_split(np.arange(len(arr)), n_shards)):
+      strings = [get_metadata_string(get_record(arr[idx])) for idx in idxs]
+      save_pickle(get_shard_path(shard_dir, 'records', shard), {
+        'strings': strings,
+        'signatures': [get_stored_hashvalues(i) for i in strings],
+      })
+    save_pickle(os.path.join(shard_dir, 'plan.pickle'), plan)
+
+  # run the shards locally, or wait for the workers on other machines
+  signature_paths = [get_shard_path(shard_dir, 'signatures', shard) for shard in range(n_shards)]
+  pair_paths = [get_shard_path(shard_dir, 'pairs', shard) for shard in range(n_shards)]
+  if remote_shards:
+    print(' * waiting for', n_shards, 'shards in', shard_dir + '. On each worker run:')
+    print('   python find_dupes.py shard', shard_dir, '<shard>')
+    with timed('signature'):
+      wait_for_paths(signature_paths)
+    with timed('query'):
+      wait_for_paths(pair_paths)
+  else:
+    with ProcessPoolExecutor(min(n_shards, os.cpu_count() or 1)) as executor:
+      with timed('signature'):
+        list(executor.map(run_signature_shard, [shard_dir] * n_shards, range(n_shards)))
+      with timed('query'):
+        list(executor.map(run_band_shard, [shard_dir] * n_shards, range(n_shards)))
+
+  # save the signatures computed by the shards
+  with timed('signature'), db:
+    for path in signature_paths:
+      db.executemany('INSERT OR IGNORE INTO signatures VALUES (?, ?, ?, ?)',
+        [(string, n_perms, shingle_size, hashvalues) for string, hashvalues in load_pickle(path)])
+
+  # merge the pairs of all shards, adding each pair in both directions and
+  # each record to its own matches, as one sorted array of a * n + b keys
+  with timed('query'):
+    n = len(arr)
+    pairs = np.concatenate([np.load(path) for path in pair_paths])
+    a = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+    b = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+    keys = np.unique(a * n + b)
+    starts = np.searchsorted(keys // n, np.arange(1, n))
+    return [i.tolist() for i in np.split(keys % n, starts)]
+
+
+def run_shard(shard_dir, shard):
+  '''
+  Run both steps of `shard` in `shard_dir` as a worker of a remote sharded
+  run, waiting for the signatures of all shards in between
+  '''
+  plan_path = os.path.join(shard_dir, 'plan.pickle')
+  wait_for_paths([plan_path])
+  run_signature_shard(shard_dir, shard)
+  n = load_pickle(plan_path)['n_shards']
+  wait_for_paths([get_shard_path(shard_dir, 'bands', source, shard) for source in range(n)])
+  run_band_shard(shard_dir, shard)
+
+
+def run_signature_shard(shard_dir, shard):
+  '''
+  Minhash the records of `shard` whose signatures were not saved before and
+  save the new signatures. Then save the columns of the signatures of all
+  records of the shard that belong to the bands of each shard.
+  '''
+  plan = load_pickle(os.path.join(shard_dir, 'plan.pickle'))
+  records = load_pickle(get_shard_path(shard_dir, 'records', shard))
+  hashvalues = np.empty((len(records['strings']), plan['n_perms']), dtype = np.uint64)
+  new_signatures = []
+  for idx, (string, stored) in enumerate(zip(records['strings'], records['signatures'])):
+    if stored is None:
+      stored = compute_minhash(string, plan['n_perms'], plan['shingle_size']).hashvalues.tobytes()
+      new_signatures.append((string, stored))
+    hashvalues[idx] = np.frombuffer(stored, dtype = np.uint64)
+  save_pickle(get_shard_path(shard_dir, 'signatures', shard), new_signatures)
+  for target, columns in enumerate(plan['columns']):
+    save_npy(get_shard_path(shard_dir, 'bands', shard, target), hashvalues[:, columns])
+
+
+def run_band_shard(shard_dir, shard):
+  '''
+  Bucket the records by each band of `shard` and save the pairs of records
+  that share a bucket
+  '''
+  plan = load_pickle(os.path.join(shard_dir, 'plan.pickle'))
+  hashvalues = np.vstack([np.load(get_shard_path(shard_dir, 'bands', source, shard))
+    for source in range(plan['n_shards'])])
+  rows_per_band = plan['rows_per_band']
+  pairs = set()
+  for start in range(0, hashvalues.shape[1], rows_per_band):
+    buckets = {}
+    for idx, band in enumerate(hashvalues[:, start:start + rows_per_band]):
+      buckets.setdefault(band.tobytes(), []).append(idx)
+    for bucket in buckets.values():
+      for a in range(len(bucket)):
+        for b in range(a + 1, len(bucket)):
+          pairs.add((bucket[a], bucket[b]))
+  save_npy(get_shard_path(shard_dir, 'pairs', shard),
+    np.array(sorted(pairs), dtype = np.int64).reshape(-1, 2))
+
+
+def get_shard_path(shard_dir, kind, *shards):
+  '''Return the path of the file of `kind` for `shards` in `shard_dir`'''
+  ext = '.npy' if kind in ('bands', 'pairs') else '.pickle'
+  return os.path.join(shard_dir, '-'.join([kind] + [str(i) for i in shards]) + ext)
+
+
+def wait_for_paths(paths):
+  '''Wait until all `paths` exist'''
+  while not all(os.path.exists(path) for path in paths):
+    time.sleep(1)
+
+
+def save_npy(path, arr):
+  '''
+  Save `arr` to `path` via a temporary file, so readers polling for `path`
+  never see a partial file
+  '''
+  with open(path + '.tmp', 'wb') as out:
+    np.save(out, arr)
+  os.replace(path + '.tmp', path)
+
+
+def save_pickle(path, obj):
+  '''
+  Save `obj` to `path` via a temporary file, so readers polling for `path`
+  never see a partial file and an interrupted run cannot corrupt it
+  '''
+  with open(path + '.tmp', 'wb') as out:
+    pickle.dump(obj, out, pickle.HIGHEST_PROTOCOL)
+  os.replace(path + '.tmp', path)
+
+
+def load_pickle(path):
+  '''Return the object saved in the pickle at `path`'''
+  with open(path, 'rb') as f:
+    return pickle.load(f)
+
+
 def identify_diplomats(arr, deduped = None):
   '''
-  `arr` is a list of dictionaries where each dictionary represents
-  the content from one Google or EndNote record. Return two dictionaries,
-  one of which identifies the whitelisted values (diplomats), the other
-  of which identifies blacklisted values (dupes). Dictionnaries are read
-  from disk when `deduped` is True.
+  `arr` is a list of rows in the record table, where each row represents
+  one Google or EndNote record. Return two sets, one of which identifies
+  the whitelisted rows (diplomats), the other of which identifies
+  blacklisted rows (dupes). Sets are read from disk when `deduped` is True.
   '''
 
-  blacklist = {} # each key is an id that represents a dupe
-  whitelist = {} # each key is an id that represents a diplomat
+  blacklist = set() # each value is a row that represents a dupe
+  whitelist = set() # each value is a row that represents a diplomat
 
   # get the clusters
   clusters = find_clusters(arr)
@@ -166,118 +766,142 @@ def identify_diplomats(arr, deduped = None):
 
     # case of a single-value cluster - nothing similar to this value in index
     if len(cluster) == 1:
-      obj = cluster[0]
-      whitelist[obj['id']] = obj
+      whitelist.add(cluster[0])
 
     # case where pairwise distances need to be computed
     else:
       multi_clusters.append(cluster)
 
+  # each member of a cluster finds the same cluster, so score each one once
+  multi_clusters = list({tuple(cluster): cluster for cluster in multi_clusters}.values())
+
   # identify the total number of 'multiclusters'
   n_multiclusters = len(multi_clusters)
 
-  # prompt the user for input on each cluster
-  prompt = get_prompt()
+  # score and render the clusters in the background, easiest clusters first
+  reviews = get_review_queue(multi_clusters)
 
-  for cluster_idx, cluster in enumerate(multi_clusters):
+  for cluster_idx in range(n_multiclusters):
+    with timed('review queue wait'):
+      review = reviews.get()
+    if isinstance(review, Exception):
+      raise review
+    cluster = review['cluster']
 
     # skip clusters that have already been deduped
-    if all([(i['id'] in whitelist) or (i['id'] in blacklist) for i in cluster]):
+    if all([(i['row'] in whitelist) or (i['row'] in blacklist) for i in cluster]):
       continue
 
-    # sort the vals in cluster so that endnote always comes first
-    cluster = sort_cluster(cluster)
-
-    # get the list of similarities within this cluster
-    sims = []
-    for idx, _ in enumerate(cluster):
-      if idx + 1 < len(cluster):
-        sims.append(get_string_similarity(cluster[idx], cluster[idx+1]))
-
     # get the prompt to show the user the pairwise similarities
-    msg = get_prompt_message(whitelist, cluster, cluster_idx, n_multiclusters, sims)
+    msg = get_prompt_message(whitelist, review)
 
     # if analyzing exactly two records, one from google and one from endnote,
-    # if the the years match, and if the pairwise similarity is >= ceiling,
-    # then whitelist endnote and blacklist google
-    collections = [i['collection'] for i in cluster]
-
-    if (sorted(collections) == sorted(['google', 'endnote']) and
-      cluster[0]['year'] == cluster[1]['year'] and
-      sims[0] >= ceiling):
+    # if the the years match, and if the pairwise similarity is >= ceiling
+    # or their first author and titles match, then whitelist endnote and
+    # blacklist google
+    if is_clear_dupe(review):
 
       # whitelist the endnote and blacklist the google val
       for i in cluster:
         if i['collection'] == 'endnote':
-          whitelist[i['id']] = i
+          whitelist.add(i['row'])
         elif i['collection'] == 'google':
-          blacklist[i['id']] = i
+          blacklist.add(i['row'])
       continue
 
     # when deduping google vs. endnote and analyzing only records from the same collection,
     # whitelist all records - they were already deduped
+    collections = [i['collection'] for i in cluster]
     if deduped:
       if len(set(collections)) <= 1:
         for i in cluster:
-          whitelist[i['id']] = i
+          whitelist.add(i['row'])
         continue
 
     # keep prompting until user gives a valid response
-    response_valid = False
-    while not response_valid:
-      user_keys = prompt(msg).strip().lower()
-
-      # if user sent the `a` key, keep all records in cluster
-      if user_keys == 'a':
-        # vals to whitelist is a list of dictionaries
-        vals_to_whitelist = cluster
-        vals_to_blacklist = []
-
-      elif any([i in numbers for i in user_keys]):
-        # make sure the number(s) provided are valid index positions
-        try:
-          if any([int(i) > len(cluster) for i in user_keys.split(',')]):
-            print('\n ! Warning: Invalid response received. Try again.')
-            continue
-        except:
-          print('\n ! Warning: Invalid response received. Try again.')
-          continue
+    whitelist, blacklist = review_cluster(cluster, msg, whitelist, blacklist)
+  return whitelist, blacklist
 
-        # the received values were all valid indices
-        whitelist_indices = [int(i)-1 for i in user_keys.split(',')]
-        blacklist_indices = [i for i in range(len(cluster)) if i not in whitelist_indices]
-        vals_to_whitelist = [cluster[i] for i in whitelist_indices]
-        vals_to_blacklist = [cluster[i] for i in blacklist_indices]
 
-      else:
+def is_clear_dupe(review):
+  '''
+  Return True if the scored cluster in `review` holds one Google and one
+  EndNote record from the same year whose metadata similarity is at least
+  `ceiling`, so the Google record can be dropped without review. With the
+  author-year index, records whose first author and title match by
+  is_title_match are clear duplicates as well.
+  '''
+  cluster = review['cluster']
+  collections = [i['collection'] for i in cluster]
+  if sorted(collections) != sorted(['google', 'endnote']) or cluster[0]['year'] != cluster[1]['year']:
+    return False
+  if review['sims']['metadata'][0][1] >= ceiling:
+    return True
+  return author_year_index and is_title_match(cluster[0], cluster[1])
+
+
+def review_cluster(cluster, msg, whitelist, blacklist):
+  '''
+  Show `msg` to the user until they give a valid response for the records
+  in `cluster`, then add the rows of those records to `whitelist` or
+  `blacklist` as instructed
+  '''
+  prompt = get_prompt()
+  response_valid = False
+  while not response_valid:
+    user_keys = prompt(msg).strip().lower()
+
+    # if user sent the `a` key, keep all records in cluster
+    if user_keys == 'a':
+      # vals to whitelist is a list of dictionaries
+      vals_to_whitelist = cluster
+      vals_to_blacklist = []
+
+    elif any([i in numbers for i in user_keys]):
+      # make sure the number(s) provided are valid index positions
+      try:
+        if any([int(i) > len(cluster) for i in user_keys.split(',')]):
+          print('\n ! Warning: Invalid response received. Try again.')
+          continue
+      except:
         print('\n ! Warning: Invalid response received. Try again.')
         continue
 
-      # if there are goog and endnote candidates, ensure the user whitelisted
-      # at least one endnote record
-      has_goog = any([j for j in cluster if j['collection'] == 'google'])
-      has_endnote = any([j for j in cluster if j['collection'] == 'endnote'])
-      endnote_whitelisted = any([j for j in vals_to_whitelist if j['collection'] == 'endnote'])
+      # the received values were all valid indices
+      whitelist_indices = [int(i)-1 for i in user_keys.split(',')]
+      blacklist_indices = [i for i in range(len(cluster)) if i not in whitelist_indices]
+      vals_to_whitelist = [cluster[i] for i in whitelist_indices]
+      vals_to_blacklist = [cluster[i] for i in blacklist_indices]
 
-      if has_goog and has_endnote and not endnote_whitelisted:
-        print(' ! Warning: When records are duplicates, EndNote must be retained. Try again.')
-        continue
+    else:
+      print('\n ! Warning: Invalid response received. Try again.')
+      continue
 
-      response_valid = True
+    # if there are goog and endnote candidates, ensure the user whitelisted
+    # at least one endnote record
+    has_goog = any([j for j in cluster if j['collection'] == 'google'])
+    has_endnote = any([j for j in cluster if j['collection'] == 'endnote'])
+    endnote_whitelisted = any([j for j in vals_to_whitelist if j['collection'] == 'endnote'])
 
-      # add all whitelist records
-      for i in vals_to_whitelist:
-        if i['id'] in blacklist.keys():
-          whitelist, blacklist = challenge_before_whitelist(i, whitelist, blacklist)
-        else:
-          whitelist[i['id']] = i
+    if has_goog and has_endnote and not endnote_whitelisted:
+      print(' ! Warning: When records are duplicates, EndNote must be retained. Try again.')
+      continue
 
-      # add all blacklist records
-      for i in vals_to_blacklist:
-        if i['id'] in whitelist.keys():
-          whitelist, blacklist = challenge_before_blacklist(i, whitelist, blacklist)
-        else:
-          blacklist[i['id']] = i
+    response_valid = True
+
+    # add all whitelist records
+    for i in vals_to_whitelist:
+      if i['row'] in blacklist:
+        whitelist, blacklist = challenge_before_whitelist(i, whitelist, blacklist)
+      else:
+        whitelist.add(i['row'])
+
+    # add all blacklist records
+    for i in vals_to_blacklist:
+      if i['row'] in whitelist:
+        whitelist, blacklist = challenge_before_blacklist(i, whitelist, blacklist)
+      else:
+        blacklist.add(i['row'])
   return whitelist, blacklist
 
 
@@ -288,11 +912,11 @@ def challenge_before_whitelist(obj, whitelist, blacklist):
   validate_msg += obj['id'] + '. press w/b to whitelist/blacklist:\n'
   validate = prompt(validate_msg).lower().strip()
   if validate == 'w':
-    delete(obj['id'], blacklist)
-    whitelist[obj['id']] = obj
+    delete(obj['row'], blacklist)
+    whitelist.add(obj['row'])
   elif validate == 'b':
-    delete(obj['id'], whitelist)
-    blacklist[obj['id']] = obj
+    delete(obj['row'], whitelist)
+    blacklist.add(obj['row'])
   return whitelist, blacklist
 
 
@@ -303,26 +927,31 @@ def challenge_before_blacklist(obj, whitelist, blacklist):
   validate_msg += obj['id'] + '. press w/b to whitelist/blacklist:\n'
   validate = prompt(validate_msg).lower().strip()
   if validate == 'w':
-    delete(obj['id'], blacklist)
-    whitelist[obj['id']] = obj
+    delete(obj['row'], blacklist)
+    whitelist.add(obj['row'])
   elif validate == 'b':
-    delete(obj['id'], whitelist)
-    blacklist[obj['id']] = obj
+    delete(obj['row'], whitelist)
+    blacklist.add(obj['row'])
   return whitelist, blacklist
 
 
 def get_prompt():
   '''Return a function that can be used to prompt the user for input'''
   try:
-    return input
+    prompt = input
   except:
-    return raw_input
+    prompt = raw_input
+
+  def timed_prompt(msg):
+    with timed('human wait'):
+      return prompt(msg)
+  return timed_prompt
 
 
 def delete(key, obj):
-  '''Try to delete key from obj'''
+  '''Try to remove key from the set obj'''
   try:
-    del obj[key]
+    obj.remove(key)
   except Exception:
     print(' ! Warning: Could not delete', key)
 
@@ -339,8 +968,28 @@ def sort_cluster(cluster):
   return _sorted
 
 
-def get_prompt_message(whitelist, cluster, cluster_idx, n_clusters, sims):
+def get_prompt_message(whitelist, review):
   '''Get a prompt with instructions for the user'''
+  msg = review['header']
+
+  # check if any of these values have been added to whitelist
+  for i in review['cluster']:
+    if i['row'] in whitelist:
+      msg += '\nAttention: The following records have been whitelisted:\n'
+      msg += json.dumps(reorder_object_keys(i), indent=4)
+      msg += '\n\n'
+
+  return msg + review['body']
+
+
+def render_review(review, cluster_idx, n_clusters):
+  '''
+  Add the parts of the prompt that do not depend on the reviewer's previous
+  decisions to `review`. The whitelist notice is added by get_prompt_message.
+  '''
+  cluster = review['cluster']
+  sims = review['sims']
+
   msg = '\n------------------------------------------------------------------\n'
   msg += 'Please type a comma-separated list of integers, where each integer\n'
   msg += 'represents the index position of a record to be treated as unique.\n'
@@ -348,25 +997,22 @@ def get_prompt_message(whitelist, cluster, cluster_idx, n_clusters, sims):
   msg += '------------------------------------------------------------------\n\n'
   msg += ' * considering cluster ' + str(cluster_idx+1) + ' of ' + str(n_clusters) + '\n'
 
-  # add the string similarity between the members of the cluster
-  for idx, _ in enumerate(cluster):
-    if idx + 1 < len(cluster):
-      msg += ' * similarity between ' + str(idx+1) + ' and ' + str(idx+2)
-      msg += ': ' + str(sims[idx]) + '\n\n'
-
-  # check if any of these values have been added to whitelist
-  if any([i['id'] in whitelist for i in cluster]):
-    matched_vals = []
-    for i in cluster:
-      if i['id'] in whitelist:
-        msg += '\nAttention: The following records have been whitelisted:\n'
-        msg += json.dumps(reorder_object_keys(i), indent=4)
-        msg += '\n\n'
+  # add the string similarity between each pair of members of the cluster
+  msg += ' * similarity (' + ' / '.join(similarity_fields) + '):\n'
+  for a in range(len(cluster)):
+    for b in range(a + 1, len(cluster)):
+      vals = ['{0:.2f}'.format(sims[field][a][b]) for field in similarity_fields]
+      msg += '   ' + str(a+1) + ' and ' + str(b+1) + ': ' + ' / '.join(vals) + '\n'
+  msg += '\n'
 
+  body = ''
   for idx, i in enumerate(cluster):
     o = json.dumps(reorder_object_keys(i), indent=4)
-    msg += str(idx + 1) + ': ' + o + '\n'
-  return msg
+    body += str(idx + 1) + ': ' + o + '\n'
+
+  review['header'] = msg
+  review['body'] = body
+  return review
 
 
 def reorder_object_keys(obj):
@@ -378,31 +1024,275 @@ def reorder_object_keys(obj):
   return d
 
 
-def get_string_similarity(obj_a, obj_b):
+def get_string_similarity(obj_a, obj_b, field = None):
   '''Given the full record objects for two Google or EndNote results, return
-  the similarity between the metadata strings from those objects'''
-  a = get_metadata_string(obj_a)
-  b = get_metadata_string(obj_b)
+  the similarity between the metadata strings from those objects, or between
+  their values for `field` if one is given'''
+  if field and field != 'metadata':
+    a = obj_a.get(field, '')
+    b = obj_b.get(field, '')
+  else:
+    a = get_metadata_string(obj_a)
+    b = get_metadata_string(obj_b)
   return SequenceMatcher(None, a, b, autojunk=False).ratio()
 
 
 ##
-# Build a report
+# Review queue
+##
+
+# the fields for which pairwise similarities are computed within each cluster
+similarity_fields = ['metadata', 'title', 'authors', 'year', 'source']
+
+
+def score_cluster(cluster):
+  '''
+  Given a cluster, return a dictionary with the cluster sorted so EndNote
+  records come first, the full pairwise similarity matrix for each of the
+  `similarity_fields`, a confidence score for the cluster and the cpu time
+  spent scoring it
+  '''
+  cpu = time.process_time()
+  cluster = sort_cluster(cluster)
+  sims = {}
+  for field in similarity_fields:
+    matrix = [[1.0] * len(cluster) for _ in cluster]
+    for a in range(len(cluster)):
+      for b in range(a + 1, len(cluster)):
+        sim = get_string_similarity(cluster[a], cluster[b], field)
+        matrix[a][b] = sim
+        matrix[b][a] = sim
+    sims[field] = matrix
+
+  # the confidence is the similarity of the least similar pair, so clusters
+  # whose members are all near-identical are reviewed first
+  pairs = [sims['metadata'][a][b] for a in range(len(cluster))
+    for b in range(a + 1, len(cluster))]
+
+  return {
+    'cluster': cluster,
+    'sims': sims,
+    'confidence': min(pairs) if pairs else 1.0,
+    'cpu': time.process_time() - cpu,
+  }
+
+
+def get_review_queue(clusters):
+  '''
+  Given a list of multi-record clusters of rows, return a queue from which the
+  reviews for those clusters can be read in order of decreasing confidence.
+  A background thread scores the clusters and keeps the next
+  `prerender_prompts` prompts rendered while the user answers earlier ones.
+  '''
+  reviews = queue.Queue(maxsize = prerender_prompts)
+
+  # start the worker processes from the main thread, as forking a process
+  # from a thread other than the main one can deadlock
+  executor = ProcessPoolExecutor()
+  cluster_records = [[get_record(row) for row in cluster] for cluster in clusters]
+  results = executor.map(score_cluster, cluster_records, chunksize = 64)
+
+  def worker():
+    try:
+      with timed('similarity'), executor:
+        scored = list(results)
+      # the clusters are scored in the worker processes, so add their cpu time
+      timings['similarity']['cpu'] += sum(review['cpu'] for review in scored)
+      scored.sort(key = lambda review: review['confidence'], reverse = True)
+      for cluster_idx, review in enumerate(scored):
+        reviews.put(render_review(review, cluster_idx, len(scored)))
+    except Exception as exc:
+      # hand the error to the main thread instead of leaving it waiting
+      reviews.put(exc)
+
+  thread = threading.Thread(target = worker)
+  thread.daemon = True
+  thread.start()
+  return reviews
+
+
+##
+# Watch mode
 ##
 
-def count_file_lines(path):
+def watch():
   '''
-  Count the number of lines in a file at `path`. If the file
-  doesn't exist, return a 0 as there were no records to save
-  for that file.
+  Keep the lsh index of the master whitelist in memory and dedupe the new
+  Google records in results/ as soon as the scraper writes them. Clear
+  duplicates and records without matches are resolved automatically; the
+  user is prompted only for the ambiguous clusters.
   '''
+  if not count_decisions('master'):
+    print('\n\n ! Warning: Run find_dupes.py to completion once before watching results/.\n')
+    return
+
+  # warm the indexes with the records retained by earlier runs
+  whitelist, blacklist = read_decisions('master')
+  index = MinHashLSH(threshold = threshold, num_perm = n_perms)
+  key_index = {}
+  new_signatures = []
+  for idx, row in enumerate(sorted(whitelist)):
+    print_progress('indexed', idx, len(whitelist))
+    watch_insert(row, get_minhash(row, new_signatures), index, key_index)
+  with db:
+    db.executemany('INSERT OR IGNORE INTO signatures VALUES (?, ?, ?, ?)', new_signatures)
+
+  # keep the ids of the processed records in memory instead of querying them
+  processed = set(i for (i,) in db.execute('SELECT id FROM processed_google_ids'))
+
+  # dedupe the records scraped since the last run, then only those read
+  # from the files the scraper adds
+  print(' * watching results/ for new Google records')
+  results = [i for records in load_google_results().values() for i in records]
   try:
-    with codecs.open(path, 'r', 'utf8') as f:
-      return len(f.read().rstrip().split('\n'))
-  except FileNotFoundError:
-    return 0
+    while True:
+      rows = []
+      for google_dict in results:
+        if google_dict['id'] not in processed:
+          processed.add(google_dict['id'])
+          rows.append(add_record(google_dict))
+      if rows:
+        dedupe_new_google(rows, index, key_index, whitelist, blacklist)
+      time.sleep(watch_interval)
+      results = update_google_results(save = False)
+  finally:
+    save_google_results()
+
+
+def watch_insert(row, m, index, key_index):
+  '''Add the record in `row` with MinHash `m` to the indexes of watch mode'''
+  index.insert(row, m)
+  key = get_author_year_key(get_record(row))
+  if key:
+    key_index.setdefault(key, set()).add(row)
+
+
+def watch_remove(row, index, key_index):
+  '''Remove the record in `row` from the indexes of watch mode'''
+  if row in index:
+    index.remove(row)
+  key = get_author_year_key(get_record(row))
+  if key in key_index:
+    key_index[key].discard(row)
+
+
+def watch_query(row, m, index, key_index):
+  '''
+  Return the set of rows in the indexes of watch mode that are candidate
+  duplicates of the record in `row` with MinHash `m`
+  '''
+  matches = set(index.query(m))
+  key = get_author_year_key(get_record(row))
+  if author_year_index and key:
+    for query_key in get_author_year_query_keys(key):
+      matches.update(key_index.get(query_key, []))
+  return matches
 
 
+def dedupe_new_google(rows, index, key_index, whitelist, blacklist):
+  '''
+  Dedupe the new Google records in `rows` against the records in the lsh
+  `index` and the author-year `key_index`, whose rows are in the master
+  `whitelist`, and save the decisions
+  '''
+  google_whitelist = set()
+  google_blacklist = set()
+  master_whitelist = set()
+  master_blacklist = set()
+  new_signatures = []
+  ambiguous = []
+
+  # resolve records without matches and clear duplicates of a single EndNote record
+  for row in rows:
+    m = get_minhash(row, new_signatures)
+    matches = watch_query(row, m, index, key_index)
+    if not matches:
+      google_whitelist.add(row)
+      master_whitelist.add(row)
+      watch_insert(row, m, index, key_index)
+      continue
+    review = score_cluster([get_record(j) for j in [row] + sorted(matches)])
+    if is_clear_dupe(review):
+      # a duplicate of an endnote record is retained against google only
+      google_whitelist.add(row)
+      master_blacklist.add(row)
+      continue
+    ambiguous.append((row, m))
+
+  print(' *', len(rows), 'new Google records,', len(ambiguous), 'need review')
+  whitelist.update(master_whitelist)
+  blacklist.update(master_blacklist)
+  with db:
+    db.executemany('INSERT OR IGNORE INTO signatures VALUES (?, ?, ?, ?)', new_signatures)
+    save_decisions('google', google_whitelist, google_blacklist)
+    save_decisions('master', master_whitelist, master_blacklist)
+    cache_parsed_google_ids(google_whitelist | google_blacklist)
+
+  # prompt for the ambiguous clusters, querying again to include records
+  # retained earlier in this loop
+  for cluster_idx, (row, m) in enumerate(ambiguous):
+    matches = watch_query(row, m, index, key_index)
+
+    # earlier reviews may have dropped all the matches of this record
+    if not matches:
+      white, black = set([row]), set()
+    else:
+      review = score_cluster([get_record(j) for j in [row] + sorted(matches)])
+      render_review(review, cluster_idx, len(ambiguous))
+      white, black = review_cluster(review['cluster'], get_prompt_message(set(), review), set(), set())
+
+    # a dropped google record is a duplicate of a retained google record if
+    # there is one, as batch runs dedupe google against itself first
+    retained_google = any(records['collection'][j] == 'google' for j in white)
+    google_whitelist = set()
+    google_blacklist = set()
+    master_whitelist = set()
+    master_blacklist = set()
+    if row in white:
+      google_whitelist.add(row)
+      master_whitelist.add(row)
+      watch_insert(row, m, index, key_index)
+    elif retained_google:
+      google_blacklist.add(row)
+    else:
+      google_whitelist.add(row)
+      master_blacklist.add(row)
+
+    # drop the existing records that are no longer retained from the index
+    for j in black - set([row]):
+      watch_remove(j, index, key_index)
+      master_blacklist.add(j)
+      if records['collection'][j] == 'google' and retained_google:
+        google_blacklist.add(j)
+    whitelist.difference_update(master_blacklist)
+    whitelist.update(master_whitelist)
+    blacklist.update(master_blacklist)
+
+    with db:
+      save_decisions('google', google_whitelist, google_blacklist)
+      save_decisions('master', master_whitelist, master_blacklist)
+      cache_parsed_google_ids([row])
+
+  export_lists()
+
+
+def export_lists():
+  '''
+  Export the google and master lists and the deduplicated Google records
+  from the project store
+  '''
+  with timed('output write'):
+    save_tsv('google', 'whitelist', 'lists/google_whitelist.tsv')
+    save_tsv('google', 'blacklist', 'lists/google_blacklist.tsv')
+    save_tsv('master', 'whitelist', 'lists/master_whitelist.tsv')
+    save_tsv('master', 'blacklist', 'lists/master_blacklist.tsv')
+    save_tsv('master', 'whitelist', 'lists/deduped_google_records.tsv', collection = 'google')
+
+
+##
+# Build a report
+##
+
 def build_reports():
   '''
   Build a report that indicates:
@@ -411,20 +1301,12 @@ def build_reports():
     - Records retained after deduplication against EndNote
   '''
 
-  google_blacklist_count = count_file_lines(os.path.join('lists', 'google_blacklist.tsv'))
-  google_whitelist_count = count_file_lines(os.path.join('lists', 'google_whitelist.tsv'))
+  google_blacklist_count = count_decisions('google', 'blacklist')
+  google_whitelist_count = count_decisions('google', 'whitelist')
 
   # count the number of google records in the master whitelist
-  with codecs.open(os.path.join('lists', 'master_whitelist.tsv'), 'r', 'utf8') as f:
-    rows = f.read().rstrip().split('\n')
-    google_master_whitelist_vals = []
-    for i in rows:
-      vendor = i.rstrip().split('\t')[-1]
-      if vendor == 'google':
-        google_master_whitelist_vals.append(i)
-
-  with codecs.open('lists/deduped_google_records.tsv', 'w', 'utf8') as out:
-    out.write('\n'.join(google_master_whitelist_vals))
+  google_master_whitelist_count = save_tsv('master', 'whitelist',
+    'lists/deduped_google_records.tsv', collection = 'google')
 
   with codecs.open('report.txt', mode) as out:
     if only_process_new_google:
@@ -432,73 +1314,135 @@ def build_reports():
     out.write('Timestamp: ' + str(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')) + '\n')
     out.write('Unique Google IDs retrieved:\t\t' + str(google_blacklist_count + google_whitelist_count) + '\n')
     out.write('Deduplicated against itself:\t\t' + str(google_whitelist_count) + '\n')
-    out.write('Deduplicated against EndNote:\t\t' + str(len(google_master_whitelist_vals)) + '\n\n')
+    out.write('Deduplicated against EndNote:\t\t' + str(google_master_whitelist_count) + '\n\n')
+
+  # save the time spent in each phase next to the report
+  save_timings('timings.json')
+
+
+##
+# Instrumentation
+##
+
+# the wall and cpu seconds spent in each phase of the run
+timings = {}
+
+# the start time and last print time of each progress label
+progress = {}
+
+
+@contextmanager
+def timed(phase):
+  '''
+  Add the wall and process cpu time spent in the body of the with statement
+  to `timings[phase]`
+  '''
+  wall = time.perf_counter()
+  cpu = time.process_time()
+  try:
+    yield
+  finally:
+    timing = timings.setdefault(phase, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+    timing['wall'] += time.perf_counter() - wall
+    timing['cpu'] += time.process_time() - cpu
+    timing['calls'] += 1
+
+
+def print_progress(label, idx, total):
+  '''
+  Print how many of `total` items have been `label` and at what rate. Print
+  at most once every `progress_interval` seconds, plus for the last item.
+  '''
+  now = time.perf_counter()
+  if idx == 0:
+    progress[label] = {'started': now, 'printed': now}
+  state = progress[label]
+  if idx + 1 < total and now - state['printed'] < progress_interval:
+    return
+  state['printed'] = now
+  elapsed = now - state['started']
+  # the rate over a few microseconds is meaningless, so leave it out
+  if elapsed < 0.01:
+    print(' ' + label, idx + 1, 'of', total)
+    return
+  rate = (idx + 1) / elapsed
+  print(' ' + label, idx + 1, 'of', total, '(' + str(int(rate)) + ' per second)')
+
+
+def save_timings(path):
+  '''
+  Save the time spent in each phase, and the peak memory use if it is
+  traced, as json to `path`
+  '''
+  out = {
+    'timestamp': str(datetime.datetime.now()),
+    'note': 'similarity runs in the background while the user reviews clusters, so it ' +
+      'overlaps review queue wait and human wait, and the phases do not add up to the run time',
+    'phases': timings,
+  }
+  if tracemalloc.is_tracing():
+    out['peak_memory'] = tracemalloc.get_traced_memory()[1]
+  with open(path, 'w') as f:
+    json.dump(out, f, indent = 2)
 
 
 ##
 # Outputs
 ##
 
-def save_tsv(d, filename):
+def save_tsv(stage, list_name, filename, collection = None):
   '''
-  Given a dictionary whose keys are _id attributes of a dict, and whose
-  value is the full object that contains _id, write each dict as a row in a
-  tsv with `filename`
+  Write each record in the `list_name` list ('whitelist' or 'blacklist') of
+  `stage` in the project store as a row in a tsv with `filename`. If
+  `collection` is given, write only the records from that collection.
+  Return the number of records written.
   '''
-  key_list = ['id', 'authors', 'year', 'title', 'source', 'url', 'collection']
+  query = '''SELECT ''' + ', '.join('r.' + i for i in record_fields) + '''
+    FROM decisions d JOIN records r ON r.id = d.id
+    WHERE d.stage = ? AND d.list = ?'''
+  params = [stage, list_name]
+  if collection:
+    query += ' AND r.collection = ?'
+    params.append(collection)
 
   # write tsv
-  if d:
-    with open(filename, mode) as out:
-      for _id in d.keys():
-        for key in key_list:
-          out.write(d[_id].get(key, '') + '\t')
-        out.write('\n')
+  n_rows = 0
+  with codecs.open(filename, 'w', 'utf8') as out:
+    for row in db.execute(query + ' ORDER BY d.rowid', params):
+      # titles may contain tabs, which would shift the cells of the row
+      out.write('\t'.join(i.replace('\t', ' ') for i in row) + '\t\n')
+      n_rows += 1
+  return n_rows
 
 
-def get_wb(l, filename, read = None):
+def get_wb(l, stage, read = None):
   '''
-  Given a list of dictionaries (endnote_vals or google_vals) and a filename
-  in which the deduped vals from that list of dictionaries should be saved,
-  return the whitelisted and blacklisted values from `l`. If read is True,
-  fetch whitelist and blacklist from disk instead.
+  Given a list of rows (endnote_vals or google_vals) and the stage of the
+  project store in which the deduped rows from that list should be saved,
+  return the whitelisted and blacklisted rows from `l`. If read is True,
+  fetch whitelist and blacklist from the project store instead.
   '''
-  # if there are no (new) records, return empty lists
+  # if there are no (new) records, return empty sets
   if len(l) == 0:
-    return [], []
+    return set(), set()
 
-  path = 'json/' + filename
+  if count_decisions(stage):
 
-  if os.path.exists(path):
-    
-    # in read-mode, fetch saved values from disk
+    # in read-mode, fetch saved values from the project store
     if read:
-      whitelist, blacklist = json.load(open(path))
-      return whitelist, blacklist
-    
+      return read_decisions(stage)
+
     # if `l` is comprised of google records and  user wants to process only
     # new google records, fetch the white and blacklists for the new google
     # records, and add those to the existing lists
-    if only_process_new_google and l[0]['collection'] == 'google':
+    if only_process_new_google and records['collection'][l[0]] == 'google':
       new_white, new_black = identify_diplomats(l)
-      with open(path) as out:
-        whitelist, blacklist = json.load(out)
-      whitelist.update(new_white)
-      blacklist.update(new_black)
-      with open(path, 'w') as out:
-        json.dump([
-          dict(whitelist),
-          dict(blacklist)
-          ], out)
+      save_decisions(stage, new_white, new_black)
       return new_white, new_black
 
   # generate whitelist and blacklist
   whitelist, blacklist = identify_diplomats(l)
-  with open(path, 'w') as out:
-    json.dump([
-      dict(whitelist),
-      dict(blacklist)
-    ], out)
+  save_decisions(stage, whitelist, blacklist, replace = True)
   return whitelist, blacklist
 
 
@@ -506,41 +1450,270 @@ def get_wb(l, filename, read = None):
 # Save used Google IDs
 ##
 
-def cache_parsed_google_ids():
+def cache_parsed_google_ids(rows):
+  '''
+  Save the Google IDs of `rows`, the records used in this round of analysis,
+  so they do not have to be processed again, and export the full list of
+  processed ids
+  '''
+  goog_ids = [(records['id'][row],) for row in rows]
+  db.executemany('INSERT OR IGNORE INTO processed_google_ids VALUES (?)', goog_ids)
+  with open('lists/processed_google_ids.txt', 'w') as out:
+    for (google_id,) in db.execute('SELECT id FROM processed_google_ids ORDER BY rowid'):
+      out.write(google_id + '\n')
+
+
+##
+# Project store
+##
+
+def open_project_store(path):
+  '''
+  Open the sqlite database at `path` that holds the records, signatures,
+  whitelist and blacklist decisions and run metadata of the project
+  '''
+  conn = sqlite3.connect(path)
+  conn.executescript('''
+    CREATE TABLE IF NOT EXISTS records (
+      id TEXT PRIMARY KEY, authors TEXT, year TEXT, title TEXT,
+      source TEXT, url TEXT, collection TEXT);
+    CREATE TABLE IF NOT EXISTS decisions (
+      stage TEXT, id TEXT, list TEXT, PRIMARY KEY (stage, id));
+    CREATE INDEX IF NOT EXISTS decisions_by_list ON decisions (stage, list);
+    CREATE TABLE IF NOT EXISTS signatures (
+      metadata TEXT, n_perms INTEGER, shingle_size INTEGER, hashvalues BLOB,
+      PRIMARY KEY (metadata, n_perms, shingle_size));
+    CREATE TABLE IF NOT EXISTS processed_google_ids (id TEXT PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS runs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT, finished TEXT, settings TEXT);
+  ''')
+  return conn
+
+
+def count_decisions(stage, list_name = None):
+  '''
+  Return the number of records of `stage` in the project store, or the
+  number of those in the `list_name` list if one is given
+  '''
+  if list_name:
+    query = 'SELECT COUNT(*) FROM decisions WHERE stage = ? AND list = ?'
+    return db.execute(query, (stage, list_name)).fetchone()[0]
+  return db.execute('SELECT COUNT(*) FROM decisions WHERE stage = ?', (stage,)).fetchone()[0]
+
+
+def read_decisions(stage):
+  '''
+  Add the records of `stage` in the project store to the record table and
+  return the sets of whitelisted and blacklisted rows
+  '''
+  whitelist = set()
+  blacklist = set()
+  query = '''SELECT d.list, ''' + ', '.join('r.' + i for i in record_fields) + '''
+    FROM decisions d JOIN records r ON r.id = d.id WHERE d.stage = ?'''
+  for values in db.execute(query, (stage,)):
+    row = add_record(dict(zip(record_fields, values[1:])))
+    if values[0] == 'whitelist':
+      whitelist.add(row)
+    else:
+      blacklist.add(row)
+  return whitelist, blacklist
+
+
+def save_decisions(stage, whitelist, blacklist, replace = None):
+  '''
+  Save the whitelisted and blacklisted rows of `stage` and their records to
+  the project store. If replace is True, drop the earlier decisions of
+  `stage` first. The caller commits the transaction.
+  '''
+  if replace:
+    db.execute('DELETE FROM decisions WHERE stage = ?', (stage,))
+  for list_name, rows in [('whitelist', whitelist), ('blacklist', blacklist)]:
+    db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)',
+      [tuple(records[field][row] for field in record_fields) for row in rows])
+    db.executemany('INSERT OR REPLACE INTO decisions VALUES (?, ?, ?)',
+      [(stage, records['id'][row], list_name) for row in sorted(rows)])
+
+  # drop records that no stage refers to anymore
+  db.execute('DELETE FROM records WHERE id NOT IN (SELECT id FROM decisions)')
+
+
+def get_stored_signature(metadata_string):
+  '''
+  Return the MinHash of `metadata_string` saved in the project store, or None
+  if it has not been computed with `n_perms` permutations and `shingle_size`
+  character shingles before
+  '''
+  stored = get_stored_hashvalues(metadata_string)
+  if stored is None:
+    return None
+  return MinHash(hashvalues = np.frombuffer(stored, dtype = np.uint64),
+    permutations = get_permutations(n_perms))
+
+
+def get_stored_hashvalues(metadata_string):
+  '''
+  Return the bytes of the hash values of the MinHash of `metadata_string`
+  saved in the project store, or None, as get_stored_signature
+  '''
+  query = 'SELECT hashvalues FROM signatures WHERE metadata = ? AND n_perms = ? AND shingle_size = ?'
+  stored = db.execute(query, (metadata_string, n_perms, shingle_size)).fetchone()
+  return stored[0] if stored else None
+
+
+def is_processed(google_id):
+  '''Return True if the record with `google_id` was processed in an earlier run'''
+  query = 'SELECT 1 FROM processed_google_ids WHERE id = ?'
+  return db.execute(query, (google_id,)).fetchone() is not None
+
+
+def start_run(settings):
+  '''Save the start time and the `settings` of this run and return its id'''
+  with db:
+    cursor = db.execute('INSERT INTO runs (started, settings) VALUES (?, ?)',
+      (str(datetime.datetime.now()), json.dumps(settings)))
+  return cursor.lastrowid
+
+
+def finish_run(run_id):
+  '''Save the end time of the run with `run_id`'''
+  with db:
+    db.execute('UPDATE runs SET finished = ? WHERE id = ?',
+      (str(datetime.datetime.now()), run_id))
+
+
+##
+# Import state saved before the project store
+##
+
+def import_legacy_state():
+  '''
+  Import the whitelists and blacklists saved in json/ and lists/ and the
+  processed Google ids into an empty project store
   '''
-  Save/append all Google IDs used in this round of analysis so they do not have to be
-  processed again
+  with db:
+    if not db.execute('SELECT COUNT(*) FROM decisions').fetchone()[0]:
+      for stage, filename in [('google', 'google_vals.json'), ('endnote', 'endnote_vals.json')]:
+        if os.path.exists(os.path.join('json', filename)):
+          print(' * importing', filename, 'into', db_path)
+          whitelist, blacklist = read_snapshot(filename)
+          save_decisions(stage, whitelist, blacklist)
+      master_whitelist = read_tsv(os.path.join('lists', 'master_whitelist.tsv'))
+      master_blacklist = read_tsv(os.path.join('lists', 'master_blacklist.tsv'))
+      save_decisions('master', master_whitelist, master_blacklist)
+
+    path = os.path.join('lists', 'processed_google_ids.txt')
+    if os.path.exists(path) and not db.execute('SELECT COUNT(*) FROM processed_google_ids').fetchone()[0]:
+      with open(path) as f:
+        goog_ids = [(i,) for i in f.read().split('\n') if i]
+      db.executemany('INSERT OR IGNORE INTO processed_google_ids VALUES (?)', goog_ids)
+
+
+def read_tsv(path):
   '''
-  goog_ids = [i['id'] for i in google_vals]
-  with open('lists/processed_google_ids.txt', mode) as out:
-    out.write('\n'.join(goog_ids) + '\n')
+  Add the records in the tsv at `path` to the record table and return the set
+  of their rows. If the file doesn't exist, return an empty set.
+  '''
+  rows = set()
+  if not os.path.exists(path):
+    return rows
+  with codecs.open(path, 'r', 'utf8') as f:
+    for line in f:
+      cells = line.rstrip('\n').split('\t')
+      if len(cells) >= len(record_fields):
+        rows.add(add_record(dict(zip(record_fields, cells))))
+  return rows
+
+
+def read_snapshot(filename):
+  '''
+  Return the sets of whitelisted and blacklisted rows saved in json/`filename`
+  '''
+  with open(os.path.join('json', filename)) as f:
+    whitelist, blacklist = json.load(f)
+  return set(add_record(i) for i in whitelist.values()), set(add_record(i) for i in blacklist.values())
 
 
 if __name__ == '__main__':
+  # run one shard of a sharded run, e.g. on another machine
+  if len(sys.argv) == 4 and sys.argv[1] == 'shard':
+    run_shard(sys.argv[2], int(sys.argv[3]))
+    sys.exit()
+
   # global
   threshold = 0.60
   ceiling = 0.85 # auto-whitelist only endnote if similarity with goog record >= ceiling
   n_perms = 256
+  shingle_size = 3 # number of characters in each shingle of the minhashed metadata string
+  author_year_index = True # also match records on first author surname, year and leading title words
+  title_key_words = 3 # number of leading title words in the author-year key
+  prerender_prompts = 10 # number of review prompts to render ahead of the user
   developing = False
   max_dev_records = 5000
   dedupe_google = False
   dedupe_endnote = False
   dedupe_endnote_v_google = True
   only_process_new_google = False # set to true to process only new records (requires complete deduping vs. endnote)
+  db_path = 'project.db' # sqlite database that holds the records, decisions and run metadata
+  google_cache_path = 'google_results.pickle' # snapshot of all records in results/
+  endnote_path = 'endnote.txt' # tab-separated, RIS (.ris) or EndNote XML (.xml) export
+  progress_interval = 2 # minimum seconds between progress lines
+  max_malformed_msgs = 10 # number of malformed records of each kind printed for an EndNote export
+  watch_interval = 5 # seconds between checks of results/ in watch mode
+  n_shards = 1 # split the lsh bands across this many shard processes; 1 to use a single index
+  shard_dir = 'shards' # directory shared with the shard workers
+  remote_shards = False # if True, wait for workers on other machines instead of local processes
+  profile = False # save a cProfile of the run to find_dupes.pstats
+  trace_memory = False # record the peak memory use in timings.json with tracemalloc
 
   # initialize numbers
   numbers = [str(i + 1) for i in range(9)]
 
+  # start the optional profilers
+  if profile:
+    profiler = cProfile.Profile()
+    profiler.enable()
+  if trace_memory:
+    tracemalloc.start()
+
   # prepare assets
   prepare_directories()
-  google_vals = get_google_vals() # list of dicts
-  endnote_vals = get_endnote_vals() # list of dicts
+  db = open_project_store(db_path)
+  import_legacy_state()
+
+  # keep deduping new google records as the scraper writes them
+  if len(sys.argv) == 2 and sys.argv[1] == 'watch':
+    try:
+      watch()
+    except KeyboardInterrupt:
+      print(' * stopped watching results/')
+    finally:
+      # watch mode runs until it is interrupted, so save the measurements on the way out
+      save_timings('timings.json')
+      if profile:
+        profiler.disable()
+        profiler.dump_stats('find_dupes.pstats')
+    sys.exit()
+
+  run_id = start_run({
+    'threshold': threshold,
+    'ceiling': ceiling,
+    'n_perms': n_perms,
+    'shingle_size': shingle_size,
+    'author_year_index': author_year_index,
+    'dedupe_google': dedupe_google,
+    'dedupe_endnote': dedupe_endnote,
+    'dedupe_endnote_v_google': dedupe_endnote_v_google,
+    'only_process_new_google': only_process_new_google,
+  })
+  with timed('load'):
+    google_vals = get_google_vals() # list of rows
+    endnote_vals = get_endnote_vals() # list of rows
 
   # force google vs. google if vals cannot be fetched from disk
-  if not os.path.exists('json/google_vals.json'):
+  if not count_decisions('google'):
     if dedupe_endnote_v_google and (not dedupe_google or
       (dedupe_google and only_process_new_google)):
-      override_msg('google_vals.json', 'Google')
+      override_msg('google', 'Google')
       dedupe_google = True
       only_process_new_google = False
 
@@ -555,7 +1728,7 @@ if __name__ == '__main__':
       print(' Do NOT partially complete this update, otherwise lists will go out of sync.)\n')
       dedupe_endnote_v_google = True
 
-  # config whether to write or append to lists of records
+  # config whether to write or append to the report
   if only_process_new_google:
     mode = 'a'
   else:
@@ -566,17 +1739,23 @@ if __name__ == '__main__':
     print('\n------------------------------------------------------------------')
     print('Deduping Google vs. Google')
     print('------------------------------------------------------------------\n')
-    google_whitelist, google_blacklist = get_wb(google_vals, 'google_vals.json')
-    save_tsv(google_whitelist, 'lists/google_whitelist.tsv')
-    save_tsv(google_blacklist, 'lists/google_blacklist.tsv')
-
-    # cache the google ids used in the analysis
-    cache_parsed_google_ids()
+    with db:
+      google_whitelist, google_blacklist = get_wb(google_vals, 'google')
+
+      # cache the google ids used in the analysis. When they are deduped
+      # against endnote as well, they are cached with the master decisions,
+      # so an interrupted update processes them again.
+      if not dedupe_endnote_v_google:
+        with timed('output write'):
+          cache_parsed_google_ids(google_vals)
+    with timed('output write'):
+      save_tsv('google', 'whitelist', 'lists/google_whitelist.tsv')
+      save_tsv('google', 'blacklist', 'lists/google_blacklist.tsv')
 
   # force endnote vs. endnote if vals cannot be fetched from disk
-  if not os.path.exists('json/endnote_vals.json'):
+  if not count_decisions('endnote'):
     if dedupe_endnote_v_google and not dedupe_endnote:
-      override_msg('endnote_vals.json', 'EndNote')
+      override_msg('endnote', 'EndNote')
       dedupe_endnote = True
 
   # dedupe endnote vs. endnote
@@ -584,30 +1763,42 @@ if __name__ == '__main__':
     print('\n------------------------------------------------------------------')
     print('Deduping EndNote vs. EndNote')
     print('------------------------------------------------------------------\n')
-    endnote_whitelist, endnote_blacklist = get_wb(endnote_vals, 'endnote_vals.json')
-    save_tsv(endnote_whitelist, 'lists/endnote_whitelist.tsv')
-    save_tsv(endnote_blacklist, 'lists/endnote_blacklist.tsv')
+    with db:
+      endnote_whitelist, endnote_blacklist = get_wb(endnote_vals, 'endnote')
+    with timed('output write'):
+      save_tsv('endnote', 'whitelist', 'lists/endnote_whitelist.tsv')
+      save_tsv('endnote', 'blacklist', 'lists/endnote_blacklist.tsv')
 
   # dedupe google vs. endnote
   if dedupe_endnote_v_google:
     if not dedupe_google:
-      google_whitelist, google_blacklist = get_wb(google_vals, 'google_vals.json', read = True)
+      google_whitelist, google_blacklist = get_wb(google_vals, 'google', read = True)
     if not dedupe_endnote:
-      endnote_whitelist, endnote_blacklist = get_wb(endnote_vals, 'endnote_vals.json', read = True)
-    deduped_google_vals = list(dict(google_whitelist).values())
-    deduped_endnote_vals = list(dict(endnote_whitelist).values())
+      endnote_whitelist, endnote_blacklist = get_wb(endnote_vals, 'endnote', read = True)
+    deduped_google_vals = sorted(google_whitelist)
+    deduped_endnote_vals = sorted(endnote_whitelist)
     print('\n------------------------------------------------------------------')
     print('Deduping Google vs. EndNote')
     print('Deduped Google records: ' + str(len(deduped_google_vals)))
     print('Deduped EndNote records: ' + str(len(deduped_endnote_vals)))
     print('------------------------------------------------------------------\n')
-    master_whitelist, master_blacklist = identify_diplomats(
-      deduped_google_vals + deduped_endnote_vals, deduped = True)
-    save_tsv(master_whitelist, 'lists/master_whitelist.tsv')
-    save_tsv(master_blacklist, 'lists/master_blacklist.tsv')
+    with db:
+      master_whitelist, master_blacklist = identify_diplomats(
+        deduped_google_vals + deduped_endnote_vals, deduped = True)
+      save_decisions('master', master_whitelist, master_blacklist,
+        replace = not only_process_new_google)
+      if dedupe_google:
+        with timed('output write'):
+          cache_parsed_google_ids(google_vals)
+    with timed('output write'):
+      save_tsv('master', 'whitelist', 'lists/master_whitelist.tsv')
+      save_tsv('master', 'blacklist', 'lists/master_blacklist.tsv')
 
     # build the final reports
-    if os.path.exists('lists/master_whitelist.tsv') and os.path.exists('lists/master_blacklist.tsv'):
-      build_reports()
-    else:
-      print('\n\n ! Warning: Reports could not be generated because master lists are missing.\n')
\ No newline at end of file
+    build_reports()
+
+  finish_run(run_id)
+
+  if profile:
+    profiler.disable()
+    profiler.dump_stats('find_dupes.pstats')
\ No newline at end of file
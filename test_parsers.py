@@ -0,0 +1,104 @@
+'''
+Check the parsers of EndNote exports on tiny tab-separated, RIS and
+EndNote XML fixtures. Run with `python -m pytest test_parsers.py`.
+'''
+import find_dupes
+
+find_dupes.max_malformed_msgs = 10
+
+
+def parse(tmp_path, filename, content):
+  '''Write `content` to `filename` in `tmp_path` and return the parsed records'''
+  path = tmp_path / filename
+  path.write_bytes(content.encode('utf8'))
+  return list(find_dupes.iter_endnote_records(str(path)))
+
+
+def test_tsv(tmp_path, capsys):
+  content = ''.join([
+    'Smith, A.\t2001\tFirst title\tJournal 1 1-2\n',
+    '\n',
+    'Doe, J.\t2002\tTrailing tab\tJournal 2 3-4\t\n',
+    'Roe, B.\t2003\tTab\tin title\tJournal 3 5-6\r\n',
+    'Poe, E.\t2004\tForm\x0cfeed and   breaks\tJournal 4 7-8\n',
+    'too few cells\n',
+    'Low, C.\t2005\tEmpty source\t',
+  ])
+  records = parse(tmp_path, 'endnote.txt', content)
+  assert records == [
+    {'authors': 'Smith, A.', 'year': '2001', 'title': 'First title', 'source': 'Journal 1 1-2'},
+    {'authors': 'Doe, J.', 'year': '2002', 'title': 'Trailing tab', 'source': 'Journal 2 3-4'},
+    {'authors': 'Roe, B.', 'year': '2003', 'title': 'Tab\tin title', 'source': 'Journal 3 5-6'},
+    {'authors': 'Poe, E.', 'year': '2004', 'title': 'Form\x0cfeed and   breaks', 'source': 'Journal 4 7-8'},
+    {'authors': 'Low, C.', 'year': '2005', 'title': 'Empty source', 'source': ''},
+  ]
+  out = capsys.readouterr().out
+  assert 'Reading title with tabs in record' in out and 'at line 4' in out
+  assert 'Skipping malformed record' in out and 'at line 6' in out
+  assert '1 malformed records skipped' in out
+  assert '1 titles with tabs read' in out
+
+
+def test_malformed_msgs_are_capped(tmp_path, capsys):
+  find_dupes.max_malformed_msgs = 2
+  try:
+    assert parse(tmp_path, 'endnote.txt', 'bad\n' * 50) == []
+  finally:
+    find_dupes.max_malformed_msgs = 10
+  out = capsys.readouterr().out
+  assert out.count('Skipping malformed record') == 2
+  assert '50 malformed records skipped' in out
+
+
+def test_ris(tmp_path, capsys):
+  content = '\n'.join([
+    '\ufeffTY  - JOUR',
+    'AU  - Smith, A.',
+    'AU  - Doe, J.',
+    'AU  - Roe, B.',
+    'PY  - 2001///',
+    'TI  - A title',
+    'T2  - Journal',
+    'VL  - 4',
+    'SP  - 166',
+    'EP  - 179',
+    'ER  - ',
+    '',
+    'TY  - BOOK',
+    'A1  - Poe, E.',
+    'Y1  - 2002',
+    'T1  - A book',
+    'ER  - ',
+    'no tag here',
+    'TY  - JOUR',
+    'TI  - Not closed',
+  ])
+  records = parse(tmp_path, 'endnote.ris', content)
+  assert records == [
+    {'authors': 'Smith, A., Doe, J. & Roe, B.', 'year': '2001', 'title': 'A title', 'source': 'Journal 4 166-179'},
+    {'authors': 'Poe, E.', 'year': '2002', 'title': 'A book', 'source': ''},
+  ]
+  out = capsys.readouterr().out
+  assert 'at line 18: no tag here' in out
+  assert 'record without an ER tag' in out
+  assert '2 malformed records skipped' in out
+
+
+def test_endnote_xml(tmp_path, capsys):
+  record = ('<record><contributors><authors><author>{0}</author><author>Doe, J.</author>'
+    '</authors></contributors><titles><title><style>{1}</style></title>'
+    '<secondary-title>Journal</secondary-title></titles><volume>4</volume>'
+    '<pages>1-2</pages><dates><year>{2}</year></dates></record>')
+  content = ('<?xml version="1.0" encoding="UTF-8"?><xml><records>' +
+    record.format('Smith, A.', 'A title', '2001') + record.format('Roe, B.', 'Another title', '2002') +
+    '</records></xml>')
+  records = parse(tmp_path, 'endnote.xml', content)
+  assert records == [
+    {'authors': 'Smith, A. & Doe, J.', 'year': '2001', 'title': 'A title', 'source': 'Journal 4 1-2'},
+    {'authors': 'Roe, B. & Doe, J.', 'year': '2002', 'title': 'Another title', 'source': 'Journal 4 1-2'},
+  ]
+
+  # the records before a parse error are kept
+  records = parse(tmp_path, 'broken.xml', content[:content.rindex('<record>')] + '<record><oops></record>')
+  assert [i['title'] for i in records] == ['A title']
+  assert 'Skipping malformed record' in capsys.readouterr().out
@@ -0,0 +1,65 @@
+'''
+Check that the sharded lsh mode finds the same clusters as a single
+MinHashLSH index on a synthetic corpus. Run with
+`python -m pytest test_sharding.py`.
+'''
+from random import Random
+import threading
+import benchmark
+import find_dupes
+import pytest
+
+
+@pytest.fixture(scope = 'module')
+def corpus_rows():
+  '''Add a synthetic corpus to the record table and return its rows'''
+  find_dupes.threshold = 0.6
+  find_dupes.n_perms = 128
+  find_dupes.shingle_size = 3
+  find_dupes.title_key_words = 3
+  find_dupes.developing = False
+  find_dupes.progress_interval = float('inf')
+  find_dupes.remote_shards = False
+  find_dupes.db = find_dupes.open_project_store(':memory:')
+  return [find_dupes.add_record(i) for i in benchmark.get_corpus(1500, Random(2))]
+
+
+def get_clusters(rows, n_shards, shard_dir, author_year_index = False):
+  '''Return the clusters find_clusters finds for `rows` with `n_shards` shards'''
+  find_dupes.n_shards = n_shards
+  find_dupes.shard_dir = str(shard_dir)
+  find_dupes.author_year_index = author_year_index
+  return find_dupes.find_clusters(rows)
+
+
+@pytest.mark.parametrize('n_shards', [2, 3])
+@pytest.mark.parametrize('author_year_index', [False, True])
+def test_sharded_clusters_match_single_index(corpus_rows, tmp_path, n_shards, author_year_index):
+  # the shards compute the signatures, which the single index then reads from the store
+  find_dupes.db = find_dupes.open_project_store(':memory:')
+  sharded = get_clusters(corpus_rows, n_shards, tmp_path, author_year_index)
+  assert find_dupes.db.execute('SELECT COUNT(*) FROM signatures').fetchone()[0] > 0
+  expected = get_clusters(corpus_rows, 1, tmp_path, author_year_index)
+  assert any(len(i) > 1 for i in expected)
+  assert sharded == expected
+
+
+def test_more_shards_than_records(corpus_rows, tmp_path):
+  rows = corpus_rows[:3]
+  assert get_clusters(rows, 5, tmp_path) == get_clusters(rows, 1, tmp_path)
+
+
+def test_remote_workers(corpus_rows, tmp_path):
+  expected = get_clusters(corpus_rows, 1, tmp_path)
+
+  # run the workers of each shard as `python find_dupes.py shard` would
+  find_dupes.remote_shards = True
+  workers = [threading.Thread(target = find_dupes.run_shard, args = (str(tmp_path), shard))
+    for shard in range(3)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  try:
+    assert get_clusters(corpus_rows, 3, tmp_path) == expected
+  finally:
+    find_dupes.remote_shards = False